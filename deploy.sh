@@ -52,6 +52,7 @@ After=network.target
 [Service]
 User=your_user
 WorkingDirectory=/path/to/your/project
+Environment=TRUSTED_PROXY_COUNT=1
 ExecStart=/usr/bin/python3 src/backend/app.py
 Restart=always
 
@@ -1,8 +1,27 @@
-from flask import Flask, jsonify, request
+from flask import Flask, jsonify, request, has_request_context, make_response
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 from clickhouse_driver import Client
+from clickhouse_driver.errors import ErrorCodes, NetworkError, ServerException, SocketTimeoutError
+from collections import OrderedDict
+from contextlib import contextmanager
+import bisect
+import click
+import fcntl
+import heapq
+import json
+from functools import wraps
 import logging
-from datetime import datetime
+import math
+import numpy as np
+import os
+import shutil
+import tempfile
+import select
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
 
 # 从test_db_connection.py中导入TEST_DATA
 TEST_DATA = {
@@ -113,6 +132,330 @@ app.config['ENV'] = 'production' if not app.debug else 'development'
 
 CORS(app, resources={r"/api/v1/*": {"origins": "*"}})
 
+# 部署在nginx之后时（见deploy.sh）设为代理层数，从X-Forwarded-For还原客户端IP，此时后端只监听本机；
+# 默认0，直连时不信任客户端传入的X-Forwarded-For
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+if TRUSTED_PROXY_COUNT:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT)
+
+# 查询治理：每个接口下发给ClickHouse的服务端限制
+QUERY_LIMITS = {
+    'get_brands': {
+        'max_execution_time': 5,
+        'max_rows_to_read': 10_000_000,
+        'max_result_bytes': 10 * 1024 * 1024
+    },
+    'get_metrics': {
+        'max_execution_time': 5,
+        'max_rows_to_read': 10_000_000,
+        'max_result_bytes': 1024 * 1024
+    },
+    'get_weekly_metrics': {
+        'max_execution_time': 15,
+        'max_rows_to_read': 50_000_000,
+        'max_result_bytes': 20 * 1024 * 1024
+    },
+    'compare_metrics': {
+        'max_execution_time': 15,
+        'max_rows_to_read': 50_000_000,
+        'max_result_bytes': 5 * 1024 * 1024
+    },
+    'snapshot_version': {
+        'max_execution_time': 10,
+        'max_rows_to_read': 50_000_000,
+        'max_result_bytes': 1024 * 1024
+    },
+    'snapshot_rebuild': {
+        'max_execution_time': 60,
+        'max_rows_to_read': 100_000_000,
+        'max_result_bytes': 200 * 1024 * 1024
+    },
+    'leaderboard_versions': {
+        'max_execution_time': 10,
+        'max_rows_to_read': 500_000_000,
+        'max_result_bytes': 1024 * 1024
+    },
+    'leaderboard_rebuild': {
+        'max_execution_time': 60,
+        'max_rows_to_read': 500_000_000,
+        'max_result_bytes': 200 * 1024 * 1024
+    }
+}
+BRANDS_DEFAULT_LIMIT = 100
+BRANDS_MAX_LIMIT = 1000
+
+# 各渠道iROAS及其花费列，排行榜按花费加权
+CHANNEL_COLUMNS = {
+    'total': ('totalIroas', 'totalSpend'),
+    'sp': ('spIroas', 'spSpend'),
+    'sb': ('sbIroas', 'sbSpend'),
+    'sd': ('sdIroas', 'sdSpend'),
+    'dsp': ('dspIroas', 'dspSpend')
+}
+COMPARE_MAX_BRANDS = 100
+# 热点品牌的本地内存映射快照
+SNAPSHOT_DIR = os.getenv('SNAPSHOT_DIR') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'snapshots')
+HOT_BRAND_IDS = tuple(int(b) for b in os.getenv('HOT_BRAND_IDS', '').split(',') if b.strip())
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv('SNAPSHOT_REFRESH_INTERVAL', 300))
+WEEKLY_COLUMNS = ['totalIroas', 'spIroas', 'sdIroas', 'sbIroas', 'dspIroas']
+SNAPSHOT_COLUMNS = WEEKLY_COLUMNS + ['totalSpend', 'spSpend', 'sdSpend', 'sbSpend', 'dspSpend']
+
+LEADERBOARD_REFRESH_INTERVAL = int(os.getenv('LEADERBOARD_REFRESH_INTERVAL', 300))
+LEADERBOARD_DEFAULT_LIMIT = 50
+LEADERBOARD_MAX_LIMIT = 500
+LEADERBOARD_WARMUP_RETRY_AFTER = 5
+
+# 每个租户（客户端IP）同时在ClickHouse上执行的查询数
+TENANT_MAX_CONCURRENT_QUERIES = int(os.getenv('TENANT_MAX_CONCURRENT_QUERIES', 4))
+TENANT_SLOT_WAIT_SECONDS = float(os.getenv('TENANT_SLOT_WAIT_SECONDS', 2))
+
+# 准入控制：每个接口的并发上限和排队时间预算（秒）
+ENDPOINT_LIMITS = {
+    'get_brands': {'max_concurrent': 16, 'queue_timeout': 0.5},
+    'get_metrics': {'max_concurrent': 16, 'queue_timeout': 0.5},
+    'get_weekly_metrics': {'max_concurrent': 32, 'queue_timeout': 1.0},
+    'compare_metrics': {'max_concurrent': 8, 'queue_timeout': 1.0},
+    'get_leaderboard': {'max_concurrent': 8, 'queue_timeout': 2.0}
+}
+OVERLOAD_RETRY_AFTER = 1
+
+# 数据库熔断：连续失败达到阈值后熔断，冷却结束后放行一次试探请求
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = float(os.getenv('CIRCUIT_RESET_TIMEOUT', 30))
+
+# 数据库不可用时用于降级返回的历史成功响应
+STALE_CACHE_MAX_ENTRIES = int(os.getenv('STALE_CACHE_MAX_ENTRIES', 1000))
+STALE_CACHE_MAX_BYTES = int(os.getenv('STALE_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+_tenant_slots = {}
+_tenant_slots_lock = threading.Lock()
+
+
+class QueryGovernanceError(Exception):
+    """查询被治理层拒绝或中止"""
+    status_code = 503
+    retry_after = None
+
+
+class QuerySlotUnavailable(QueryGovernanceError):
+    """租户并发槽位已满"""
+    status_code = 429
+    retry_after = 1
+
+
+class QueryCancelled(QueryGovernanceError):
+    """客户端已断开，查询已取消"""
+    status_code = 499
+
+
+class ServiceUnavailable(QueryGovernanceError):
+    """过载或数据库不可用，客户端应在retry_after秒后重试"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class EndpointOverloaded(ServiceUnavailable):
+    """接口并发已满且排队超出时间预算"""
+
+
+class DatabaseUnavailable(ServiceUnavailable):
+    """数据库熔断中"""
+
+
+@app.errorhandler(QueryGovernanceError)
+def handle_query_governance_error(e):
+    app.logger.warning(f"Query rejected by governance layer: {str(e)}")
+    response = jsonify({
+        'data': None,
+        'message': str(e)
+    })
+    response.status_code = e.status_code
+    if e.retry_after is not None:
+        response.headers['Retry-After'] = str(max(1, math.ceil(e.retry_after)))
+    return response
+
+
+class CircuitBreaker:
+    """数据库调用熔断器：closed -> open -> half_open -> closed
+
+    before_call返回令牌(generation, is_probe)，结果回报时带上令牌。每次熔断generation加一，
+    熔断前已发出的调用结果被忽略；半开状态下只有持有试探令牌的调用能关闭熔断或交还试探机会。
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._generation = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return 'open'
+            return 'half_open'
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return (self._generation, False)
+            remaining = self.reset_timeout - (time.monotonic() - self._opened_at)
+            if remaining > 0 or self._probing:
+                raise DatabaseUnavailable('Database circuit is open', max(remaining, 1))
+            # 冷却结束，只放行一个试探请求
+            self._probing = True
+            return (self._generation, True)
+
+    def _is_current(self, token):
+        generation, is_probe = token
+        if generation != self._generation:
+            return False
+        # 熔断期间只认试探请求的结果
+        return self._opened_at is None or is_probe
+
+    def record_success(self, token):
+        with self._lock:
+            if not self._is_current(token):
+                return
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self, token):
+        with self._lock:
+            if not self._is_current(token):
+                return
+            self._failures += 1
+            if token[1] or self._failures >= self.failure_threshold:
+                app.logger.error(f"Database circuit opened after {self._failures} failures")
+                self._opened_at = time.monotonic()
+                self._probing = False
+                self._generation += 1
+
+    def release_probe(self, token):
+        """试探请求未真正到达数据库（如被取消）时交还试探机会"""
+        with self._lock:
+            if token[1] and self._is_current(token):
+                self._probing = False
+
+
+def is_database_failure(e):
+    """连接、超时、过载类错误计入熔断；SQL本身的错误不计入"""
+    if isinstance(e, (NetworkError, SocketTimeoutError, EOFError, OSError)):
+        return True
+    return isinstance(e, ServerException) and e.code in (
+        ErrorCodes.TIMEOUT_EXCEEDED,
+        ErrorCodes.TOO_MANY_SIMULTANEOUS_QUERIES,
+        ErrorCodes.MEMORY_LIMIT_EXCEEDED
+    )
+
+
+db_circuit = CircuitBreaker(CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RESET_TIMEOUT)
+
+
+def reraise_for_admission(e):
+    """治理层拒绝和数据库故障继续抛出，由errorhandler和admission_controlled处理（返回旧数据或503）；
+    其余错误由接口自行记录并返回500"""
+    if isinstance(e, QueryGovernanceError) or is_database_failure(e):
+        raise e
+
+
+class AdmissionController:
+    """按接口限制并发，排队超过时间预算直接拒绝"""
+
+    def __init__(self, limits):
+        self._slots = {
+            endpoint: threading.BoundedSemaphore(limit['max_concurrent'])
+            for endpoint, limit in limits.items()
+        }
+        self._timeouts = {endpoint: limit['queue_timeout'] for endpoint, limit in limits.items()}
+
+    @contextmanager
+    def slot(self, endpoint):
+        slots = self._slots[endpoint]
+        if not slots.acquire(timeout=self._timeouts[endpoint]):
+            raise EndpointOverloaded(f'{endpoint} is overloaded', OVERLOAD_RETRY_AFTER)
+        try:
+            yield
+        finally:
+            slots.release()
+
+
+class StaleResponseCache:
+    """按请求路径保存最近一次成功响应，有界LRU，同时限制条目数和总字节数"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, body):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[0])
+            # 单个响应超过总预算的1/10时不缓存，避免挤掉其余条目
+            if len(body) > self.max_bytes // 10:
+                return
+            self._entries[key] = (body, time.time())
+            self._bytes += len(body)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (evicted, _) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+
+
+admission = AdmissionController(ENDPOINT_LIMITS)
+stale_responses = StaleResponseCache(STALE_CACHE_MAX_ENTRIES, STALE_CACHE_MAX_BYTES)
+
+
+def admission_controlled(endpoint):
+    """接口准入控制：限制并发和排队时间；过载、数据库熔断或数据库故障时优先返回旧数据，否则快速返回503"""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            cache_key = request.full_path
+            try:
+                with admission.slot(endpoint):
+                    response = make_response(view(*args, **kwargs))
+            except Exception as e:
+                if not isinstance(e, ServiceUnavailable) and not is_database_failure(e):
+                    raise
+                stale = stale_responses.get(cache_key)
+                if stale is None:
+                    if isinstance(e, ServiceUnavailable):
+                        raise
+                    app.logger.error(f"Database error in {endpoint}: {str(e)}")
+                    raise DatabaseUnavailable('Database is unavailable', OVERLOAD_RETRY_AFTER) from e
+                body, stored_at = stale
+                app.logger.warning(f"Serving stale response for {cache_key}: {str(e)}")
+                response = make_response(body)
+                response.mimetype = 'application/json'
+                response.headers['Age'] = str(int(time.time() - stored_at))
+                response.headers['Warning'] = '110 - "Response is Stale"'
+                return response
+            if response.status_code == 200:
+                stale_responses.put(cache_key, response.get_data())
+            return response
+        return wrapper
+    return decorator
+
+
 def get_db_connection():
     try:
         client = Client(
@@ -120,25 +463,515 @@ def get_db_connection():
             port=9000,
             user='default',
             password='123456',
-            database='incrementality'
+            database='incrementality',
+            connect_timeout=int(os.getenv('CLICKHOUSE_CONNECT_TIMEOUT', 5)),
+            send_receive_timeout=int(os.getenv('CLICKHOUSE_SEND_RECEIVE_TIMEOUT', 30))
         )
         return client
     except Exception as e:
         app.logger.error(f"ClickHouse connection error: {str(e)}")
         raise
 
+
+def get_tenant_id():
+    """按客户端IP区分租户；经ProxyFix处理后remote_addr为真实客户端地址，客户端无法自行伪造"""
+    if not has_request_context():
+        return 'system'
+    return request.remote_addr or 'default'
+
+
+@contextmanager
+def tenant_slot(tenant_id):
+    # 每个租户记录[信号量, 持有或等待者数量]，数量归零时移除，避免字典无限增长
+    with _tenant_slots_lock:
+        entry = _tenant_slots.get(tenant_id)
+        if entry is None:
+            entry = [threading.BoundedSemaphore(TENANT_MAX_CONCURRENT_QUERIES), 0]
+            _tenant_slots[tenant_id] = entry
+        entry[1] += 1
+    try:
+        if not entry[0].acquire(timeout=TENANT_SLOT_WAIT_SECONDS):
+            raise QuerySlotUnavailable(f'Too many concurrent queries for tenant {tenant_id}')
+        try:
+            yield
+        finally:
+            entry[0].release()
+    finally:
+        with _tenant_slots_lock:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _tenant_slots[tenant_id]
+
+
+def client_disconnected():
+    """检查发起当前请求的客户端连接是否已关闭"""
+    if not has_request_context():
+        return False
+    sock = request.environ.get('werkzeug.socket') or request.environ.get('gunicorn.socket')
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b''
+    except (OSError, ValueError):
+        return True
+
+
+class _FlightCall:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """合并相同的并发调用：同一个key同时只执行一次，结果分发给所有等待者"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = _FlightCall()
+                    self._calls[key] = call
+                    self.executions += 1
+                else:
+                    self.coalesced += 1
+
+            if leader:
+                try:
+                    call.result = fn()
+                    return call.result
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        del self._calls[key]
+                    call.done.set()
+
+            while not call.done.wait(0.1):
+                if client_disconnected():
+                    raise QueryCancelled('Client disconnected while waiting for a shared query')
+            # 领头请求因自身原因（断连、租户槽位）失败时，由等待者重新发起
+            if isinstance(call.error, QueryGovernanceError):
+                continue
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'in_flight': len(self._calls)
+            }
+
+
+query_flight = SingleFlight()
+
+
+def execute_query(client, endpoint, query, params=None):
+    """执行只读查询，相同SQL和参数的并发请求合并为一次ClickHouse执行"""
+    key = (endpoint, query, repr(sorted((params or {}).items())))
+    return query_flight.do(key, lambda: _execute_governed(client, endpoint, query, params))
+
+
+def _execute_governed(client, endpoint, query, params):
+    """在治理限制下执行只读查询：熔断检查、服务端限额、租户并发槽位，客户端断开时取消查询"""
+    token = db_circuit.before_call()
+    try:
+        with tenant_slot(get_tenant_id()):
+            progress = client.execute_with_progress(query, params, settings=QUERY_LIMITS[endpoint])
+            for _ in progress:
+                if client_disconnected():
+                    client.cancel()
+                    raise QueryCancelled(f'Client disconnected, cancelled query for {endpoint}')
+            result = progress.get_result()
+    except QueryGovernanceError:
+        db_circuit.release_probe(token)
+        raise
+    except Exception as e:
+        if is_database_failure(e):
+            db_circuit.record_failure(token)
+        else:
+            db_circuit.record_success(token)
+        raise
+    except BaseException:
+        # 如KeyboardInterrupt、worker超时退出等：结果未知，不计成败，但必须交还试探机会
+        db_circuit.release_probe(token)
+        raise
+    db_circuit.record_success(token)
+    return result
+
+def parse_period(value):
+    """'2024Q4' -> 20244"""
+    year, quarter = value.upper().split('Q')
+    if not 1 <= int(quarter) <= 4:
+        raise ValueError(f'Invalid quarter: {value}')
+    return int(year) * 10 + int(quarter)
+
+
+def format_period(period):
+    return f'{period // 10}Q{period % 10}'
+
+
+def _ranking_key(entry):
+    """排名顺序：iROAS降序，花费降序，品牌ID升序"""
+    iroas, spend, brand_id = entry
+    return (-iroas, -spend, brand_id)
+
+
+def _scan_ranking(ranking, min_spend, limit):
+    """按排名顺序扫描，跳过花费不足的品牌，找满limit即停止"""
+    entries = []
+    for entry in ranking:
+        if entry[1] < min_spend:
+            continue
+        entries.append(entry)
+        if len(entries) >= limit:
+            break
+    return entries
+
+
+def _top_eligible(by_spend, eligible, limit):
+    """在花费升序列表末尾eligible个满足min_spend的品牌中取排名前limit"""
+    return heapq.nsmallest(limit, by_spend[len(by_spend) - eligible:], key=_ranking_key)
+
+
+class LeaderboardIndex:
+    """按季度预计算的各渠道品牌排名，由后台线程刷新，仅重建version发生变化的季度
+
+    每个(季度, 渠道)保存两份有序列表：按iROAS降序的排名，以及按花费升序的列表（用于min_spend过滤）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._versions = {}
+        self._rankings = {}
+        self.loaded = False
+
+    def periods(self):
+        with self._lock:
+            return sorted(self._versions)
+
+    def refresh(self, client):
+        with self._refresh_lock:
+            versions = dict(execute_query(client, 'leaderboard_versions', """
+                SELECT toUInt32(year * 10 + quarter) AS period, max(version)
+                FROM incrementality.incrementalityResult_all
+                GROUP BY period
+            """))
+            with self._lock:
+                changed = [p for p, v in versions.items() if self._versions.get(p) != v]
+            rankings = self._build(client, changed) if changed else {}
+
+            with self._lock:
+                for period in set(self._versions) - set(versions):
+                    for channel in CHANNEL_COLUMNS:
+                        self._rankings.pop((period, channel), None)
+                self._rankings.update(rankings)
+                self._versions = versions
+                self.loaded = True
+            if changed:
+                app.logger.info(f"Leaderboard rebuilt for periods: {[format_period(p) for p in changed]}")
+
+    def _build(self, client, periods):
+        iroas_columns = ', '.join(f'{iroas}, {spend}' for iroas, spend in CHANNEL_COLUMNS.values())
+        aggregates = ', '.join(
+            f'sumIf({iroas} * {spend}, {iroas} IS NOT NULL), sumIf({spend}, {iroas} IS NOT NULL)'
+            for iroas, spend in CHANNEL_COLUMNS.values()
+        )
+        # 同一品牌同一周只取最新version的结果
+        rows = execute_query(client, 'leaderboard_rebuild', f"""
+            SELECT period, brandOriginalId, {aggregates}
+            FROM (
+                SELECT toUInt32(year * 10 + quarter) AS period, brandOriginalId, {iroas_columns}
+                FROM incrementality.incrementalityResult_all
+                WHERE toUInt32(year * 10 + quarter) IN %(periods)s
+                ORDER BY version DESC
+                LIMIT 1 BY brandOriginalId, reportDate
+            )
+            GROUP BY period, brandOriginalId
+        """, {'periods': tuple(periods)})
+
+        entries = {(period, channel): [] for period in periods for channel in CHANNEL_COLUMNS}
+        for row in rows:
+            period, brand_id = row[0], row[1]
+            for i, channel in enumerate(CHANNEL_COLUMNS):
+                weighted, spend = row[2 + 2 * i], row[3 + 2 * i]
+                if spend:
+                    entries[(period, channel)].append((weighted / spend, float(spend), brand_id))
+        indexes = {}
+        for key, ranking in entries.items():
+            ranking.sort(key=_ranking_key)
+            by_spend = sorted(ranking, key=lambda entry: entry[1])
+            indexes[key] = (ranking, by_spend, [entry[1] for entry in by_spend])
+        return indexes
+
+    def top(self, period, channel, limit, min_spend=0.0):
+        """返回min_spend以上排名前limit的品牌，只读内存索引
+
+        设共n个品牌、m个满足min_spend：按排名顺序扫描预计约 limit*n/m 项，
+        直接在花费有序列表的后缀中取前limit约 m 项，取两者中较小的，代价不超过约 sqrt(limit*n)。
+        """
+        with self._lock:
+            ranking, by_spend, spend_keys = self._rankings.get((period, channel), ([], [], []))
+        eligible = len(spend_keys) - bisect.bisect_left(spend_keys, min_spend)
+        if eligible * eligible <= limit * len(ranking):
+            entries = _top_eligible(by_spend, eligible, limit)
+        else:
+            entries = _scan_ranking(ranking, min_spend, limit)
+        return [{
+            'rank': rank,
+            'brandOriginalId': brand_id,
+            'iroas': iroas,
+            'spend': spend
+        } for rank, (iroas, spend, brand_id) in enumerate(entries, start=1)]
+
+
+leaderboard_index = LeaderboardIndex()
+_leaderboard_refresher_started = False
+_leaderboard_refresher_lock = threading.Lock()
+
+
+def _leaderboard_refresh_loop():
+    while True:
+        try:
+            leaderboard_index.refresh(get_db_connection())
+        except Exception as e:
+            app.logger.error(f"Error refreshing leaderboard: {str(e)}")
+        time.sleep(LEADERBOARD_REFRESH_INTERVAL)
+
+
+@app.before_request
+def start_leaderboard_refresher():
+    # 在每个worker进程fork之后才启动后台线程，请求路径只读索引
+    global _leaderboard_refresher_started
+    if _leaderboard_refresher_started:
+        return
+    with _leaderboard_refresher_lock:
+        if not _leaderboard_refresher_started:
+            threading.Thread(target=_leaderboard_refresh_loop, daemon=True).start()
+            _leaderboard_refresher_started = True
+
+
+class SeriesSnapshot:
+    """热点品牌周度序列的列式快照：每列一个.npy文件，按mmap只读加载，多个worker进程共享页缓存
+
+    目录结构：SNAPSHOT_DIR/v<version>-<build>/<brandOriginalId>/<column>.npy，
+    同目录下manifest.json记录version和构建时的品牌集合；
+    SNAPSHOT_DIR/current 符号链接指向当前版本，重建完成后原子替换。
+    """
+
+    def __init__(self, root, brand_ids):
+        self.root = root
+        self.brand_ids = frozenset(brand_ids)
+        self._lock = threading.Lock()
+        # (链接目标, 快照品牌集合是否与当前热点集合一致, 各品牌序列)，整体替换，读取时无需加锁
+        self._loaded = None
+
+    @property
+    def current_link(self):
+        return os.path.join(self.root, 'current')
+
+    def manifest(self):
+        try:
+            with open(os.path.join(self.current_link, 'manifest.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def version(self):
+        manifest = self.manifest()
+        return manifest['version'] if manifest else None
+
+    def get(self, brand_id):
+        """返回品牌的快照序列；不在热点集合、快照与当前热点集合不一致或加载失败时返回None，由调用方回源数据库"""
+        if brand_id not in self.brand_ids:
+            return None
+        try:
+            target = os.readlink(self.current_link)
+        except OSError:
+            return None
+        loaded = self._loaded
+        if loaded is None or loaded[0] != target:
+            # 只有链接目标变化时才加锁重新加载
+            with self._lock:
+                loaded = self._loaded
+                if loaded is None or loaded[0] != target:
+                    try:
+                        manifest, series = self._load(os.path.join(self.root, target))
+                    except (OSError, ValueError, KeyError) as e:
+                        app.logger.warning(f"Failed to load series snapshot {target}: {str(e)}")
+                        return None
+                    loaded = (target, set(manifest['brand_ids']) == self.brand_ids, series)
+                    self._loaded = loaded
+        _, matches_hot_set, series = loaded
+        if not matches_hot_set:
+            return None
+        return series.get(brand_id)
+
+    def _load(self, path):
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        series = {}
+        for brand_id in manifest['brand_ids']:
+            brand_dir = os.path.join(path, str(brand_id))
+            if not os.path.isdir(brand_dir):
+                # 热点品牌在库中没有数据
+                continue
+            series[brand_id] = {
+                column: np.load(os.path.join(brand_dir, f'{column}.npy'), mmap_mode='r')
+                for column in ['reportDate'] + SNAPSHOT_COLUMNS
+            }
+        return manifest, series
+
+    def refresh(self, client):
+        """热点品牌出现新version或热点集合变化时重建快照；多进程间用文件锁保证只有一个在重建"""
+        if not self.brand_ids:
+            return False
+        brand_ids = tuple(sorted(self.brand_ids))
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, '.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            rows = execute_query(client, 'snapshot_version', """
+                SELECT max(version)
+                FROM incrementality.incrementalityResult_all
+                WHERE brandOriginalId IN %(brand_ids)s
+            """, {'brand_ids': brand_ids})
+            version = rows[0][0] if rows else None
+            manifest = self.manifest()
+            if manifest and manifest['version'] == version and set(manifest['brand_ids']) == self.brand_ids:
+                return False
+            self._build(client, brand_ids, version)
+            return True
+
+    def _build(self, client, brand_ids, version):
+        rows = execute_query(client, 'snapshot_rebuild', f"""
+            SELECT brandOriginalId, reportDate, {', '.join(SNAPSHOT_COLUMNS)}
+            FROM incrementality.incrementalityResult_all
+            WHERE brandOriginalId IN %(brand_ids)s
+            ORDER BY brandOriginalId, reportDate ASC
+        """, {'brand_ids': brand_ids})
+
+        by_brand = {}
+        for row in rows:
+            by_brand.setdefault(row[0], []).append(row[1:])
+
+        name = f'v{version}-{time.time_ns()}'
+        tmp_dir = tempfile.mkdtemp(prefix='.build-', dir=self.root)
+        try:
+            for brand_id, brand_rows in by_brand.items():
+                brand_dir = os.path.join(tmp_dir, str(brand_id))
+                os.makedirs(brand_dir)
+                np.save(os.path.join(brand_dir, 'reportDate.npy'),
+                        np.array([r[0] for r in brand_rows], dtype='datetime64[D]'))
+                for i, column in enumerate(SNAPSHOT_COLUMNS, start=1):
+                    np.save(os.path.join(brand_dir, f'{column}.npy'),
+                            np.array([np.nan if r[i] is None else r[i] for r in brand_rows], dtype=np.float64))
+            with open(os.path.join(tmp_dir, 'manifest.json'), 'w') as f:
+                json.dump({'version': version, 'brand_ids': list(brand_ids)}, f)
+            os.rename(tmp_dir, os.path.join(self.root, name))
+        except Exception:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+
+        try:
+            previous = os.readlink(self.current_link)
+        except OSError:
+            previous = None
+        tmp_link = os.path.join(self.root, 'current.tmp')
+        if os.path.lexists(tmp_link):
+            os.remove(tmp_link)
+        os.symlink(name, tmp_link)
+        os.replace(tmp_link, self.current_link)
+
+        # 保留上一个版本，其他worker可能刚读到旧链接、尚未完成加载
+        for entry in os.listdir(self.root):
+            if entry.startswith('v') and entry not in (name, previous):
+                shutil.rmtree(os.path.join(self.root, entry), ignore_errors=True)
+        app.logger.info(f"Series snapshot {name} built for {len(by_brand)} brands")
+
+
+def snapshot_rows(series, start_date=None, end_date=None):
+    """按日期区间从快照切片，输出与get_weekly_metrics查询结果相同的行"""
+    dates = series['reportDate']
+    lo = np.searchsorted(dates, np.datetime64(start_date, 'D'), side='left') if start_date else 0
+    hi = np.searchsorted(dates, np.datetime64(end_date, 'D'), side='right') if end_date else len(dates)
+    columns = [dates[lo:hi].astype(object)] + [series[column][lo:hi] for column in WEEKLY_COLUMNS]
+    return [
+        tuple(None if isinstance(v, float) and np.isnan(v) else v for v in values)
+        for values in zip(*columns)
+    ]
+
+
+series_snapshot = SeriesSnapshot(SNAPSHOT_DIR, HOT_BRAND_IDS)
+_snapshot_refresher_started = False
+_snapshot_refresher_lock = threading.Lock()
+
+
+def _snapshot_refresh_loop():
+    while True:
+        try:
+            series_snapshot.refresh(get_db_connection())
+        except Exception as e:
+            app.logger.error(f"Error refreshing series snapshot: {str(e)}")
+        time.sleep(SNAPSHOT_REFRESH_INTERVAL)
+
+
+@app.before_request
+def start_snapshot_refresher():
+    # 在每个worker进程fork之后才启动后台线程
+    global _snapshot_refresher_started
+    if not HOT_BRAND_IDS or _snapshot_refresher_started:
+        return
+    with _snapshot_refresher_lock:
+        if not _snapshot_refresher_started:
+            threading.Thread(target=_snapshot_refresh_loop, daemon=True).start()
+            _snapshot_refresher_started = True
+
+
+@app.cli.command('build-snapshot')
+def build_snapshot_command():
+    """立即为HOT_BRAND_IDS重建热点序列快照"""
+    if not HOT_BRAND_IDS:
+        click.echo('HOT_BRAND_IDS is not configured')
+        return
+    rebuilt = series_snapshot.refresh(get_db_connection())
+    click.echo(f"Snapshot version: {series_snapshot.version()} ({'rebuilt' if rebuilt else 'unchanged'})")
+
+
 @app.route('/')
 def health_check():
     return jsonify({
         'status': 'healthy',
         'service': 'incrementality backend',
-        'version': '1.0.0'
+        'version': '1.0.0',
+        'singleflight': query_flight.stats(),
+        'database_circuit': db_circuit.state
     })
 
 @app.route('/api/v1/brands', methods=['GET'])
+@admission_controlled('get_brands')
 def get_brands():
     try:
         search = request.args.get('search', '')
+        limit = max(1, min(request.args.get('limit', BRANDS_DEFAULT_LIMIT, type=int), BRANDS_MAX_LIMIT))
         client = get_db_connection()
         
         if search:
@@ -154,8 +987,9 @@ def get_brands():
                 FROM brands 
                 WHERE brand_id = %(brand_id)s 
                 OR brand_name ILIKE %(search)s
+                LIMIT %(limit)s
             '''
-            params = {'brand_id': search, 'search': f'%{search}%'}
+            params = {'brand_id': search, 'search': f'%{search}%', 'limit': limit}
         else:
             query = '''
                 SELECT 
@@ -167,10 +1001,11 @@ def get_brands():
                     sbIroas, 
                     dspIroas
                 FROM brands
+                LIMIT %(limit)s
             '''
-            params = {}
+            params = {'limit': limit}
             
-        brands = client.execute(query, params)
+        brands = execute_query(client, 'get_brands', query, params)
         return jsonify({
             'data': [dict(zip(
                 ['brand_id', 'brand_name', 'totalIroas', 'spIroas', 'sdIroas', 'sbIroas', 'dspIroas'], 
@@ -179,6 +1014,7 @@ def get_brands():
             'message': 'Success'
         })
     except Exception as e:
+        reraise_for_admission(e)
         app.logger.error(f"Error in get_brands: {str(e)}")
         return jsonify({
             'data': [],
@@ -186,6 +1022,7 @@ def get_brands():
         }), 500
 
 @app.route('/api/v1/metrics/<int:brand_id>', methods=['GET'])
+@admission_controlled('get_metrics')
 def get_metrics(brand_id):
     try:
         client = get_db_connection()
@@ -199,7 +1036,7 @@ def get_metrics(brand_id):
             FROM brands
             WHERE brandOriginalId = %(brand_id)s
         '''
-        metrics = client.execute(query, {'brand_id': brand_id})
+        metrics = execute_query(client, 'get_metrics', query, {'brand_id': brand_id})
         
         if metrics:
             return jsonify({
@@ -215,45 +1052,54 @@ def get_metrics(brand_id):
                 'message': 'Brand not found'
             }), 404
     except Exception as e:
+        reraise_for_admission(e)
         app.logger.error(f"Error in get_metrics: {str(e)}")
         return jsonify({
             'data': None,
             'message': 'Error occurred while fetching metrics'
         }), 500
 
+def fetch_weekly_rows(brand_id, start_date=None, end_date=None):
+    client = get_db_connection()
+    query = '''
+        SELECT 
+            reportDate,
+            totalIroas,
+            spIroas,
+            sdIroas,
+            sbIroas,
+            dspIroas
+        FROM incrementality.incrementalityResult_all
+        WHERE brandOriginalId = %(brand_id)s
+    '''
+    params = {'brand_id': brand_id}
+    
+    if start_date and end_date:
+        query += ' AND reportDate BETWEEN %(start_date)s AND %(end_date)s'
+        params.update({'start_date': start_date, 'end_date': end_date})
+    elif start_date:
+        query += ' AND reportDate >= %(start_date)s'
+        params['start_date'] = start_date
+    elif end_date:
+        query += ' AND reportDate <= %(end_date)s'
+        params['end_date'] = end_date
+        
+    query += ' ORDER BY reportDate ASC'
+    
+    return execute_query(client, 'get_weekly_metrics', query, params)
+
 @app.route('/api/v1/metrics/<int:brand_id>/weekly', methods=['GET'])
+@admission_controlled('get_weekly_metrics')
 def get_weekly_metrics(brand_id):
     try:
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
-        client = get_db_connection()
-        
-        query = '''
-            SELECT 
-                reportDate,
-                totalIroas,
-                spIroas,
-                sdIroas,
-                sbIroas,
-                dspIroas
-            FROM incrementality.incrementalityResult_all
-            WHERE brandOriginalId = %(brand_id)s
-        '''
-        params = {'brand_id': brand_id}
-        
-        if start_date and end_date:
-            query += ' AND reportDate BETWEEN %(start_date)s AND %(end_date)s'
-            params.update({'start_date': start_date, 'end_date': end_date})
-        elif start_date:
-            query += ' AND reportDate >= %(start_date)s'
-            params['start_date'] = start_date
-        elif end_date:
-            query += ' AND reportDate <= %(end_date)s'
-            params['end_date'] = end_date
-            
-        query += ' ORDER BY reportDate ASC'
-        
-        metrics = client.execute(query, params)
+
+        series = series_snapshot.get(brand_id)
+        if series is not None:
+            metrics = snapshot_rows(series, start_date, end_date)
+        else:
+            metrics = fetch_weekly_rows(brand_id, start_date, end_date)
         
         data = [{
             'reportDate': metric[0],
@@ -269,12 +1115,180 @@ def get_weekly_metrics(brand_id):
             'message': 'Success'
         })
     except Exception as e:
+        reraise_for_admission(e)
         app.logger.error(f"Error in get_weekly_metrics: {str(e)}")
         return jsonify({
             'data': [],
             'message': 'Error occurred while fetching weekly metrics'
         }), 500
 
+def comparison_window(start, end, compare):
+    """返回对比窗口：previous为紧邻的等长区间，yoy为去年同期"""
+    if compare == 'yoy':
+        def shift(day):
+            try:
+                return day.replace(year=day.year - 1)
+            except ValueError:
+                # 2月29日对齐到去年2月28日
+                return day.replace(year=day.year - 1, day=28)
+        return shift(start), shift(end)
+    days = (end - start).days + 1
+    previous_end = start - timedelta(days=1)
+    return previous_end - timedelta(days=days - 1), previous_end
+
+
+def build_comparison_query():
+    """两个窗口的加权iROAS、花费及差值、比值，一次扫描完成"""
+    inner_columns = []
+    outer_columns = []
+    for iroas, spend in CHANNEL_COLUMNS.values():
+        for window, condition in (('cur', 'in_current'), ('prev', 'in_previous')):
+            inner_columns.append(
+                f'sumIf({iroas} * {spend}, {condition} AND {iroas} IS NOT NULL)'
+                f' / nullIf(sumIf({spend}, {condition} AND {iroas} IS NOT NULL), 0) AS {window}_{iroas}'
+            )
+            inner_columns.append(f'sumIf({spend}, {condition}) AS {window}_{spend}')
+        for column in (iroas, spend):
+            outer_columns.append(
+                f'cur_{column}, prev_{column}, cur_{column} - prev_{column}, cur_{column} / nullIf(prev_{column}, 0)'
+            )
+    source_columns = ', '.join(f'{iroas}, {spend}' for iroas, spend in CHANNEL_COLUMNS.values())
+    # 同一品牌同一周只取最新version的结果
+    return f"""
+        SELECT brandOriginalId, {', '.join(outer_columns)}
+        FROM (
+            SELECT brandOriginalId, {', '.join(inner_columns)}
+            FROM (
+                SELECT
+                    brandOriginalId,
+                    {source_columns},
+                    reportDate BETWEEN %(start_date)s AND %(end_date)s AS in_current,
+                    reportDate BETWEEN %(previous_start)s AND %(previous_end)s AS in_previous
+                FROM incrementality.incrementalityResult_all
+                WHERE brandOriginalId IN %(brand_ids)s
+                AND (reportDate BETWEEN %(start_date)s AND %(end_date)s
+                    OR reportDate BETWEEN %(previous_start)s AND %(previous_end)s)
+                ORDER BY version DESC
+                LIMIT 1 BY brandOriginalId, reportDate
+            )
+            GROUP BY brandOriginalId
+        )
+        ORDER BY brandOriginalId
+    """
+
+
+COMPARISON_QUERY = build_comparison_query()
+COMPARISON_METRICS = [column for pair in CHANNEL_COLUMNS.values() for column in pair]
+
+
+@app.route('/api/v1/metrics/compare', methods=['GET'])
+@admission_controlled('compare_metrics')
+def compare_metrics():
+    try:
+        compare = request.args.get('compare', 'previous')
+        if compare not in ('previous', 'yoy'):
+            return jsonify({
+                'data': [],
+                'message': 'Invalid compare, expected previous or yoy'
+            }), 400
+        try:
+            brand_ids = tuple(int(b) for b in request.args.get('brand_ids', '').split(',') if b.strip())
+            start = datetime.strptime(request.args.get('start_date', ''), '%Y-%m-%d').date()
+            end = datetime.strptime(request.args.get('end_date', ''), '%Y-%m-%d').date()
+        except ValueError:
+            return jsonify({
+                'data': [],
+                'message': 'brand_ids, start_date and end_date (YYYY-MM-DD) are required'
+            }), 400
+        if not brand_ids or len(brand_ids) > COMPARE_MAX_BRANDS or start > end:
+            return jsonify({
+                'data': [],
+                'message': f'Expected 1-{COMPARE_MAX_BRANDS} brand_ids and start_date <= end_date'
+            }), 400
+
+        previous_start, previous_end = comparison_window(start, end, compare)
+        client = get_db_connection()
+        rows = execute_query(client, 'compare_metrics', COMPARISON_QUERY, {
+            'brand_ids': brand_ids,
+            'start_date': start,
+            'end_date': end,
+            'previous_start': previous_start,
+            'previous_end': previous_end
+        })
+
+        data = []
+        for row in rows:
+            values = [float(v) if v is not None else None for v in row[1:]]
+            data.append({
+                'brandOriginalId': row[0],
+                'metrics': {
+                    column: dict(zip(['current', 'previous', 'delta', 'ratio'], values[4 * i:4 * i + 4]))
+                    for i, column in enumerate(COMPARISON_METRICS)
+                }
+            })
+
+        return jsonify({
+            'data': data,
+            'current': {'start_date': start.isoformat(), 'end_date': end.isoformat()},
+            'previous': {'start_date': previous_start.isoformat(), 'end_date': previous_end.isoformat()},
+            'message': 'Success'
+        })
+    except Exception as e:
+        reraise_for_admission(e)
+        app.logger.error(f"Error in compare_metrics: {str(e)}")
+        return jsonify({
+            'data': [],
+            'message': 'Error occurred while comparing metrics'
+        }), 500
+
+@app.route('/api/v1/leaderboard', methods=['GET'])
+@admission_controlled('get_leaderboard')
+def get_leaderboard():
+    try:
+        channel = request.args.get('channel', 'total')
+        if channel not in CHANNEL_COLUMNS:
+            return jsonify({
+                'data': None,
+                'message': f"Invalid channel, expected one of: {', '.join(CHANNEL_COLUMNS)}"
+            }), 400
+        try:
+            period = request.args.get('period')
+            period = parse_period(period) if period else None
+        except ValueError:
+            return jsonify({
+                'data': None,
+                'message': 'Invalid period, expected format like 2024Q4'
+            }), 400
+        min_spend = request.args.get('min_spend', 0.0, type=float)
+        limit = max(1, min(request.args.get('limit', LEADERBOARD_DEFAULT_LIMIT, type=int), LEADERBOARD_MAX_LIMIT))
+
+        if not leaderboard_index.loaded:
+            raise ServiceUnavailable('Leaderboard index is still loading', LEADERBOARD_WARMUP_RETRY_AFTER)
+        periods = leaderboard_index.periods()
+        if period is None and periods:
+            period = periods[-1]
+        if period not in periods:
+            return jsonify({
+                'data': None,
+                'message': 'Period not found'
+            }), 404
+
+        return jsonify({
+            'data': {
+                'period': format_period(period),
+                'channel': channel,
+                'brands': leaderboard_index.top(period, channel, limit, min_spend)
+            },
+            'message': 'Success'
+        })
+    except Exception as e:
+        reraise_for_admission(e)
+        app.logger.error(f"Error in get_leaderboard: {str(e)}")
+        return jsonify({
+            'data': None,
+            'message': 'Error occurred while fetching leaderboard'
+        }), 500
+
 @app.route('/api/v1/test-data', methods=['POST'])
 def insert_test_data():
     try:
@@ -292,4 +1306,4 @@ def insert_test_data():
         }), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5001)
+    app.run(host='127.0.0.1' if TRUSTED_PROXY_COUNT else '0.0.0.0', port=5001)
@@ -0,0 +1,66 @@
+// 品牌周度数据的前端缓存：有界LRU，再次访问时只拉取缓存之后的新数据
+const MAX_CACHED_BRANDS = 20
+// 已有周可能以新version重算，超过该时长后整段重新拉取
+const FULL_REFRESH_TTL_MS = 10 * 60 * 1000
+
+const cache = new Map()
+
+function toIsoDate(value) {
+  const date = new Date(value)
+  return isNaN(date) ? null : date.toISOString().slice(0, 10)
+}
+
+function nextDay(isoDate) {
+  const date = new Date(`${isoDate}T00:00:00Z`)
+  date.setUTCDate(date.getUTCDate() + 1)
+  return date.toISOString().slice(0, 10)
+}
+
+function remember(key, entry) {
+  // Map按插入顺序迭代，删除后重新插入即移到最近使用
+  cache.delete(key)
+  cache.set(key, entry)
+  while (cache.size > MAX_CACHED_BRANDS) {
+    cache.delete(cache.keys().next().value)
+  }
+}
+
+export function getCachedSeries(brandId) {
+  const key = String(brandId)
+  const entry = cache.get(key)
+  if (!entry) {
+    return null
+  }
+  remember(key, entry)
+  return entry.data
+}
+
+export async function fetchSeries(brandId) {
+  const key = String(brandId)
+  let entry = cache.get(key)
+  if (entry && Date.now() - entry.fullFetchedAt > FULL_REFRESH_TTL_MS) {
+    entry = null
+  }
+  let url = `/api/v1/metrics/${key}/weekly`
+  if (entry && entry.lastDate) {
+    url += `?start_date=${nextDay(entry.lastDate)}`
+  }
+
+  const response = await fetch(url)
+  if (!response.ok) {
+    throw new Error(`HTTP error! status: ${response.status}`)
+  }
+  const payload = await response.json()
+  const fresh = (payload && payload.data) || []
+
+  let data = fresh
+  if (entry) {
+    data = fresh.length > 0 ? entry.data.concat(fresh) : entry.data
+  }
+  const lastDate = fresh.length > 0
+    ? toIsoDate(fresh[fresh.length - 1].reportDate)
+    : entry && entry.lastDate
+  const fullFetchedAt = entry && entry.lastDate ? entry.fullFetchedAt : Date.now()
+  remember(key, { data, lastDate, fullFetchedAt })
+  return data
+}
@@ -0,0 +1,57 @@
+import os
+import sys
+from datetime import date
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'backend'))
+
+import app as backend  # noqa: E402
+
+
+class FakeProgress:
+    def __init__(self, rows, packets):
+        self.rows = rows
+        self.packets = packets
+
+    def __iter__(self):
+        return iter([(1, 1)] * self.packets)
+
+    def get_result(self):
+        return self.rows
+
+
+class FakeClient:
+    """代替clickhouse_driver.Client，记录每次查询；rows可以是固定结果或按(query, params)返回结果的函数"""
+
+    def __init__(self, rows=None):
+        self.rows = rows if rows is not None else []
+        self.error = None
+        self.progress_packets = 0
+        self.calls = []
+        self.cancelled = False
+
+    def execute_with_progress(self, query, params=None, settings=None):
+        self.calls.append({'query': query, 'params': params, 'settings': settings})
+        if self.error is not None:
+            raise self.error
+        rows = self.rows(query, params) if callable(self.rows) else self.rows
+        return FakeProgress(rows, self.progress_packets)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+@pytest.fixture
+def fake_client(monkeypatch):
+    fake = FakeClient([(date(2022, 1, 3), 1.0, 2.0, None, 0.5, None)])
+    monkeypatch.setattr(backend, 'get_db_connection', lambda: fake)
+    monkeypatch.setattr(backend, '_leaderboard_refresher_started', True)
+    monkeypatch.setattr(backend, 'db_circuit', backend.CircuitBreaker(failure_threshold=5, reset_timeout=60))
+    monkeypatch.setattr(backend, 'stale_responses', backend.StaleResponseCache(100, 1024 * 1024))
+    return fake
+
+
+@pytest.fixture
+def api(fake_client):
+    return backend.app.test_client()
@@ -0,0 +1,195 @@
+import threading
+import time
+
+import pytest
+from clickhouse_driver.errors import NetworkError
+
+import app as backend
+
+
+class TestSingleFlight:
+    def test_concurrent_calls_share_one_execution(self):
+        flight = backend.SingleFlight()
+        calls = []
+        results = []
+
+        def slow_query():
+            calls.append(1)
+            time.sleep(0.2)
+            return ['row']
+
+        threads = [threading.Thread(target=lambda: results.append(flight.do('k', slow_query))) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        assert len(calls) == 1
+        assert results == [['row']] * 10
+        assert flight.stats() == {'executions': 1, 'coalesced': 9, 'in_flight': 0}
+
+    def test_query_error_is_shared_with_waiters(self):
+        flight = backend.SingleFlight()
+        started = threading.Event()
+        errors = []
+
+        def failing_query():
+            started.set()
+            time.sleep(0.1)
+            raise ValueError('bad sql')
+
+        def call():
+            try:
+                flight.do('k', failing_query)
+            except ValueError as e:
+                errors.append(e)
+
+        leader = threading.Thread(target=call)
+        leader.start()
+        started.wait()
+        follower = threading.Thread(target=call)
+        follower.start()
+        leader.join()
+        follower.join()
+
+        assert len(errors) == 2
+        assert flight.stats()['executions'] == 1
+
+    def test_waiters_retry_when_leader_fails_for_its_own_reasons(self):
+        flight = backend.SingleFlight()
+        started = threading.Event()
+        results = []
+
+        def cancelled_query():
+            started.set()
+            time.sleep(0.1)
+            raise backend.QueryCancelled('leader disconnected')
+
+        def leader():
+            with pytest.raises(backend.QueryCancelled):
+                flight.do('k', cancelled_query)
+
+        leader_thread = threading.Thread(target=leader)
+        leader_thread.start()
+        started.wait()
+        follower = threading.Thread(target=lambda: results.append(flight.do('k', lambda: ['retried'])))
+        follower.start()
+        leader_thread.join()
+        follower.join()
+
+        assert results == [['retried']]
+        assert flight.stats()['executions'] == 2
+
+
+class TestCircuitBreaker:
+    def test_opens_after_threshold_and_rejects_calls(self):
+        breaker = backend.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure(breaker.before_call())
+        assert breaker.state == 'closed'
+        breaker.record_failure(breaker.before_call())
+        assert breaker.state == 'open'
+        with pytest.raises(backend.DatabaseUnavailable) as excinfo:
+            breaker.before_call()
+        assert excinfo.value.retry_after > 0
+
+    def test_success_resets_failure_count(self):
+        breaker = backend.CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure(breaker.before_call())
+        breaker.record_success(breaker.before_call())
+        breaker.record_failure(breaker.before_call())
+        assert breaker.state == 'closed'
+
+    def test_half_open_allows_single_probe(self):
+        breaker = backend.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure(breaker.before_call())
+        time.sleep(0.06)
+        assert breaker.state == 'half_open'
+        probe = breaker.before_call()
+        with pytest.raises(backend.DatabaseUnavailable):
+            breaker.before_call()
+        breaker.record_success(probe)
+        assert breaker.state == 'closed'
+
+    def test_failed_probe_reopens(self):
+        breaker = backend.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure(breaker.before_call())
+        time.sleep(0.06)
+        breaker.record_failure(breaker.before_call())
+        assert breaker.state == 'open'
+
+    def test_results_from_calls_started_before_open_are_ignored(self):
+        breaker = backend.CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        in_flight = breaker.before_call()
+        breaker.record_failure(breaker.before_call())
+        breaker.record_success(in_flight)
+        assert breaker.state == 'open'
+
+        time.sleep(0.06)
+        probe = breaker.before_call()
+        breaker.release_probe(in_flight)
+        with pytest.raises(backend.DatabaseUnavailable):
+            breaker.before_call()
+        breaker.release_probe(probe)
+        breaker.before_call()
+
+
+class TestAdmissionController:
+    def test_rejects_when_queue_budget_is_exceeded(self):
+        admission = backend.AdmissionController({'ep': {'max_concurrent': 1, 'queue_timeout': 0.01}})
+        with admission.slot('ep'):
+            with pytest.raises(backend.EndpointOverloaded):
+                with admission.slot('ep'):
+                    pass
+        with admission.slot('ep'):
+            pass
+
+
+class TestStaleResponseCache:
+    def test_evicts_least_recently_used_within_byte_budget(self):
+        cache = backend.StaleResponseCache(max_entries=10, max_bytes=100)
+        cache.put('a', b'x' * 10)
+        cache.put('b', b'x' * 10)
+        cache.get('a')
+        for key in 'cdefghijk':
+            cache.put(key, b'x' * 10)
+        assert cache.get('b') is None
+        assert cache.get('a') is not None
+
+    def test_skips_oversized_bodies(self):
+        cache = backend.StaleResponseCache(max_entries=10, max_bytes=100)
+        cache.put('a', b'x' * 11)
+        assert cache.get('a') is None
+
+
+class TestAdmissionControlledViews:
+    def test_serves_stale_response_on_database_failure(self, api, fake_client):
+        assert api.get('/api/v1/metrics/1/weekly').status_code == 200
+
+        fake_client.error = NetworkError('connection refused')
+        response = api.get('/api/v1/metrics/1/weekly')
+        assert response.status_code == 200
+        assert 'Response is Stale' in response.headers['Warning']
+        assert response.json['data'][0]['totalIroas'] == 1.0
+
+    def test_returns_503_with_retry_after_without_stale_response(self, api, fake_client):
+        fake_client.error = NetworkError('connection refused')
+        response = api.get('/api/v1/metrics/2/weekly')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+
+class TestExecuteGoverned:
+    def test_interrupted_probe_is_released(self, fake_client, monkeypatch):
+        breaker = backend.CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        monkeypatch.setattr(backend, 'db_circuit', breaker)
+        breaker.record_failure(breaker.before_call())
+        time.sleep(0.02)
+
+        fake_client.error = KeyboardInterrupt()
+        with pytest.raises(KeyboardInterrupt):
+            backend._execute_governed(fake_client, 'get_metrics', 'SELECT 1', {})
+        assert breaker.state == 'half_open'
+
+        fake_client.error = None
+        backend._execute_governed(fake_client, 'get_metrics', 'SELECT 1', {})
+        assert breaker.state == 'closed'
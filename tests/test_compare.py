@@ -0,0 +1,91 @@
+import re
+from datetime import date
+
+import pytest
+
+import app as backend
+
+
+def metric_values(column):
+    base = backend.COMPARISON_METRICS.index(column) * 10
+    return float(base + 3), float(base + 2)
+
+
+def evaluate(expression):
+    """按外层SELECT中的表达式计算结果，用于校验列顺序与接口解析是否一致"""
+    match = re.fullmatch(r'cur_(\w+)', expression)
+    if match:
+        return metric_values(match.group(1))[0]
+    match = re.fullmatch(r'prev_(\w+)', expression)
+    if match:
+        return metric_values(match.group(1))[1]
+    match = re.fullmatch(r'cur_(\w+) - prev_\1', expression)
+    if match:
+        current, previous = metric_values(match.group(1))
+        return current - previous
+    match = re.fullmatch(r'cur_(\w+) / nullIf\(prev_\1, 0\)', expression)
+    if match:
+        current, previous = metric_values(match.group(1))
+        return current / previous
+    raise AssertionError(f'Unexpected expression: {expression}')
+
+
+def comparison_rows(query, params):
+    select = re.search(r'SELECT brandOriginalId, (.*?)\n', query).group(1)
+    values = tuple(evaluate(expression) for expression in re.split(r', (?![^()]*\))', select))
+    return [(brand_id,) + values for brand_id in params['brand_ids']]
+
+
+class TestComparisonWindow:
+    def test_previous_window_has_equal_length(self):
+        assert backend.comparison_window(date(2024, 3, 1), date(2024, 3, 31), 'previous') == \
+            (date(2024, 1, 30), date(2024, 2, 29))
+
+    def test_year_over_year_clamps_leap_day(self):
+        assert backend.comparison_window(date(2024, 2, 29), date(2024, 3, 31), 'yoy') == \
+            (date(2023, 2, 28), date(2023, 3, 31))
+
+
+class TestCompareEndpoint:
+    def test_metrics_line_up_with_query_columns(self, api, fake_client):
+        fake_client.rows = comparison_rows
+        response = api.get('/api/v1/metrics/compare?brand_ids=5,6&start_date=2024-03-01&end_date=2024-03-31')
+        assert response.status_code == 200
+
+        data = response.json['data']
+        assert [row['brandOriginalId'] for row in data] == [5, 6]
+        assert set(data[0]['metrics']) == set(backend.COMPARISON_METRICS)
+        for column in backend.COMPARISON_METRICS:
+            current, previous = metric_values(column)
+            assert data[0]['metrics'][column] == {
+                'current': current,
+                'previous': previous,
+                'delta': current - previous,
+                'ratio': pytest.approx(current / previous)
+            }
+
+    def test_windows_are_passed_to_query(self, api, fake_client):
+        fake_client.rows = []
+        response = api.get('/api/v1/metrics/compare?brand_ids=5&start_date=2024-03-01&end_date=2024-03-31&compare=yoy')
+        assert fake_client.calls[-1]['params'] == {
+            'brand_ids': (5,),
+            'start_date': date(2024, 3, 1),
+            'end_date': date(2024, 3, 31),
+            'previous_start': date(2023, 3, 1),
+            'previous_end': date(2023, 3, 31)
+        }
+        assert response.json['previous'] == {'start_date': '2023-03-01', 'end_date': '2023-03-31'}
+
+    @pytest.mark.parametrize('query', [
+        'brand_ids=5&start_date=2024-03-01&end_date=2024-03-31&compare=mom',
+        'start_date=2024-03-01&end_date=2024-03-31',
+        'brand_ids=abc&start_date=2024-03-01&end_date=2024-03-31',
+        'brand_ids=5&start_date=2024-03-01',
+        'brand_ids=5&start_date=03/01/2024&end_date=2024-03-31',
+        'brand_ids=5&start_date=2024-04-01&end_date=2024-03-31',
+        'brand_ids={}&start_date=2024-03-01&end_date=2024-03-31'.format(
+            ','.join(str(i) for i in range(backend.COMPARE_MAX_BRANDS + 1)))
+    ])
+    def test_invalid_arguments_return_400(self, api, fake_client, query):
+        assert api.get(f'/api/v1/metrics/compare?{query}').status_code == 400
+        assert fake_client.calls == []
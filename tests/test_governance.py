@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import app as backend
+
+
+class TestQueryLimits:
+    def test_endpoint_limits_are_sent_as_query_settings(self, api, fake_client):
+        api.get('/api/v1/metrics/1/weekly')
+        assert fake_client.calls[-1]['settings'] == backend.QUERY_LIMITS['get_weekly_metrics']
+
+        fake_client.rows = []
+        api.get('/api/v1/brands')
+        assert fake_client.calls[-1]['settings'] == backend.QUERY_LIMITS['get_brands']
+
+    @pytest.mark.parametrize('limit, expected', [
+        (None, backend.BRANDS_DEFAULT_LIMIT),
+        (-1000000, 1),
+        (0, 1),
+        (10, 10),
+        (10 ** 9, backend.BRANDS_MAX_LIMIT)
+    ])
+    def test_brands_limit_is_clamped(self, api, fake_client, limit, expected):
+        fake_client.rows = []
+        url = '/api/v1/brands' if limit is None else f'/api/v1/brands?limit={limit}'
+        assert api.get(url).status_code == 200
+        assert fake_client.calls[-1]['params']['limit'] == expected
+
+
+class TestTenantSlots:
+    def test_full_tenant_returns_429_with_retry_after(self, api, fake_client, monkeypatch):
+        monkeypatch.setattr(backend, 'TENANT_MAX_CONCURRENT_QUERIES', 1)
+        monkeypatch.setattr(backend, 'TENANT_SLOT_WAIT_SECONDS', 0.01)
+        with backend.tenant_slot('127.0.0.1'):
+            response = api.get('/api/v1/metrics/1/weekly')
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '1'
+        assert fake_client.calls == []
+
+    def test_other_tenants_are_not_blocked(self, monkeypatch):
+        monkeypatch.setattr(backend, 'TENANT_MAX_CONCURRENT_QUERIES', 1)
+        monkeypatch.setattr(backend, 'TENANT_SLOT_WAIT_SECONDS', 0.01)
+        with backend.tenant_slot('10.0.0.1'):
+            with backend.tenant_slot('10.0.0.2'):
+                pass
+
+    def test_idle_tenants_are_evicted(self, api):
+        release = threading.Event()
+        entered = threading.Event()
+
+        def hold():
+            with backend.tenant_slot('10.0.0.3'):
+                entered.set()
+                release.wait()
+
+        holder = threading.Thread(target=hold)
+        holder.start()
+        entered.wait()
+        assert '10.0.0.3' in backend._tenant_slots
+        release.set()
+        holder.join()
+        assert '10.0.0.3' not in backend._tenant_slots
+
+        api.get('/api/v1/metrics/1/weekly')
+        assert backend._tenant_slots == {}
+
+    def test_tenant_is_client_ip_not_header(self, api, monkeypatch):
+        seen = []
+        original = backend.tenant_slot
+
+        def recording_slot(tenant_id):
+            seen.append(tenant_id)
+            return original(tenant_id)
+
+        monkeypatch.setattr(backend, 'tenant_slot', recording_slot)
+        api.get('/api/v1/metrics/1/weekly', headers={'X-Tenant-Id': 'spoofed'})
+        assert seen == ['127.0.0.1']
+
+
+class TestDisconnectCancellation:
+    def test_disconnect_cancels_query_and_returns_499(self, api, fake_client, monkeypatch):
+        fake_client.progress_packets = 3
+        monkeypatch.setattr(backend, 'client_disconnected', lambda: True)
+        response = api.get('/api/v1/metrics/1/weekly')
+        assert response.status_code == 499
+        assert fake_client.cancelled
+
+    def test_connected_client_gets_result(self, api, fake_client):
+        fake_client.progress_packets = 3
+        response = api.get('/api/v1/metrics/1/weekly')
+        assert response.status_code == 200
+        assert not fake_client.cancelled
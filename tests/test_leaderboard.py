@@ -0,0 +1,113 @@
+import random
+
+import pytest
+
+import app as backend
+
+CHANNELS = list(backend.CHANNEL_COLUMNS)
+
+
+def leaderboard_rows(brands):
+    """brands: {period: [(brandOriginalId, iroas, spend), ...]}，各渠道使用相同的iROAS和花费"""
+    def rows(query, params):
+        if 'max(version)' in query:
+            return [(period, version) for period, (version, _) in brands.items()]
+        result = []
+        for period in params['periods']:
+            for brand_id, iroas, spend in brands[period][1]:
+                result.append((period, brand_id) + (iroas * spend, spend) * len(CHANNELS))
+        return result
+    return rows
+
+
+def rebuild_calls(fake_client):
+    return [call for call in fake_client.calls if 'LIMIT 1 BY' in call['query']]
+
+
+@pytest.fixture
+def index(fake_client, monkeypatch):
+    index = backend.LeaderboardIndex()
+    monkeypatch.setattr(backend, 'leaderboard_index', index)
+    return index
+
+
+class TestTop:
+    def test_both_strategies_return_identical_results(self):
+        rng = random.Random(7)
+        # 取值粒度粗，制造大量iROAS与花费相同的并列
+        entries = [(rng.randint(0, 5) / 2, float(rng.randint(0, 20)), brand_id) for brand_id in range(300)]
+        ranking = sorted(entries, key=backend._ranking_key)
+        by_spend = sorted(ranking, key=lambda entry: entry[1])
+        spend_keys = [entry[1] for entry in by_spend]
+
+        for min_spend in [0, 1, 5, 10, 19, 20, 21]:
+            eligible = len(spend_keys) - backend.bisect.bisect_left(spend_keys, min_spend)
+            for limit in [1, 3, 50, 500]:
+                expected = [entry for entry in ranking if entry[1] >= min_spend][:limit]
+                assert backend._scan_ranking(ranking, min_spend, limit) == expected
+                assert backend._top_eligible(by_spend, eligible, limit) == expected
+
+    def test_top_applies_min_spend_and_ranks(self, fake_client, index):
+        fake_client.rows = leaderboard_rows({20244: (1, [(1, 2.0, 10.0), (2, 3.0, 1.0), (3, 1.0, 50.0)])})
+        index.refresh(fake_client)
+
+        top = index.top(20244, 'sp', limit=10, min_spend=5)
+        assert [(row['rank'], row['brandOriginalId']) for row in top] == [(1, 1), (2, 3)]
+        assert top[0]['iroas'] == pytest.approx(2.0)
+        assert index.top(20244, 'sp', limit=10, min_spend=100) == []
+
+
+class TestRefresh:
+    def test_unchanged_versions_skip_rebuild(self, fake_client, index):
+        fake_client.rows = leaderboard_rows({20243: (1, [(1, 2.0, 10.0)]), 20244: (1, [(1, 2.0, 10.0)])})
+        index.refresh(fake_client)
+        assert len(rebuild_calls(fake_client)) == 1
+
+        index.refresh(fake_client)
+        assert len(rebuild_calls(fake_client)) == 1
+
+    def test_only_changed_periods_are_rebuilt(self, fake_client, index):
+        brands = {20243: (1, [(1, 2.0, 10.0)]), 20244: (1, [(1, 2.0, 10.0)])}
+        fake_client.rows = leaderboard_rows(brands)
+        index.refresh(fake_client)
+
+        brands[20244] = (2, [(1, 4.0, 10.0)])
+        index.refresh(fake_client)
+        assert rebuild_calls(fake_client)[-1]['params'] == {'periods': (20244,)}
+        assert index.top(20244, 'total', 1)[0]['iroas'] == pytest.approx(4.0)
+
+    def test_removed_periods_are_dropped(self, fake_client, index):
+        brands = {20243: (1, [(1, 2.0, 10.0)]), 20244: (1, [(1, 2.0, 10.0)])}
+        fake_client.rows = leaderboard_rows(brands)
+        index.refresh(fake_client)
+
+        del brands[20243]
+        index.refresh(fake_client)
+        assert index.periods() == [20244]
+        assert index.top(20243, 'total', 10) == []
+
+
+class TestLeaderboardEndpoint:
+    def test_503_before_first_load(self, api, index):
+        response = api.get('/api/v1/leaderboard')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == str(backend.LEADERBOARD_WARMUP_RETRY_AFTER)
+
+    @pytest.mark.parametrize('query', ['channel=tv', 'period=2024', 'period=2024Q5', 'period=abc'])
+    def test_invalid_arguments_return_400(self, api, fake_client, index, query):
+        fake_client.rows = leaderboard_rows({20244: (1, [(1, 2.0, 10.0)])})
+        index.refresh(fake_client)
+        assert api.get(f'/api/v1/leaderboard?{query}').status_code == 400
+
+    def test_unknown_period_returns_404(self, api, fake_client, index):
+        fake_client.rows = leaderboard_rows({20244: (1, [(1, 2.0, 10.0)])})
+        index.refresh(fake_client)
+        assert api.get('/api/v1/leaderboard?period=2020Q1').status_code == 404
+
+    def test_defaults_to_latest_period(self, api, fake_client, index):
+        fake_client.rows = leaderboard_rows({20243: (1, [(1, 2.0, 10.0)]), 20244: (1, [(2, 3.0, 10.0)])})
+        index.refresh(fake_client)
+        response = api.get('/api/v1/leaderboard?channel=sb&limit=5')
+        assert response.status_code == 200
+        assert response.json['data']['period'] == '2024Q4'
+        assert response.json['data']['brands'][0]['brandOriginalId'] == 2
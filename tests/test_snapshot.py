@@ -0,0 +1,138 @@
+import json
+import os
+from datetime import date
+
+import numpy as np
+import pytest
+
+import app as backend
+
+
+def snapshot_rows_for(versions):
+    """versions: [max(version)]，可在测试中修改以模拟新version"""
+    def rows(query, params):
+        if 'max(version)' in query:
+            return [(versions[0],)]
+        if 'brandOriginalId, reportDate' in query:
+            return [
+                (brand_id, date(2022, 1, 3 + 7 * week), 1.0 + week, 2.0, None, 0.5, None) + (10.0,) * 5
+                for brand_id in params['brand_ids'] for week in range(3)
+            ]
+        return [(date(2022, 1, 3), 9.0, 9.0, None, 9.0, None)]
+    return rows
+
+
+def version_dirs(root):
+    return sorted(entry for entry in os.listdir(root) if entry.startswith('v'))
+
+
+@pytest.fixture
+def versions(fake_client):
+    versions = [1]
+    fake_client.rows = snapshot_rows_for(versions)
+    return versions
+
+
+class TestRefresh:
+    def test_build_publishes_current_link_and_manifest(self, tmp_path, fake_client, versions):
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5, 6))
+        assert snapshot.refresh(fake_client) is True
+
+        assert os.path.islink(tmp_path / 'current')
+        with open(tmp_path / 'current' / 'manifest.json') as f:
+            assert json.load(f) == {'version': 1, 'brand_ids': [5, 6]}
+        assert snapshot.version() == 1
+        assert len(snapshot.get(5)['reportDate']) == 3
+
+    def test_unchanged_version_is_not_rebuilt(self, tmp_path, fake_client, versions):
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5,))
+        assert snapshot.refresh(fake_client) is True
+        assert snapshot.refresh(fake_client) is False
+
+        versions[0] = 2
+        assert snapshot.refresh(fake_client) is True
+        assert snapshot.version() == 2
+
+    def test_changed_hot_set_is_rebuilt(self, tmp_path, fake_client, versions):
+        backend.SeriesSnapshot(str(tmp_path), (5,)).refresh(fake_client)
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5, 6))
+        assert snapshot.refresh(fake_client) is True
+        assert snapshot.get(6) is not None
+
+    def test_keeps_previous_version_and_removes_older(self, tmp_path, fake_client, versions):
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5,))
+        built = []
+        for version in [1, 2, 3]:
+            versions[0] = version
+            snapshot.refresh(fake_client)
+            built.append(os.readlink(tmp_path / 'current'))
+        assert version_dirs(tmp_path) == sorted(built[1:])
+
+    def test_failed_build_removes_temp_dir(self, tmp_path, fake_client, versions, monkeypatch):
+        def failing_save(*args, **kwargs):
+            raise OSError('disk full')
+
+        monkeypatch.setattr(backend.np, 'save', failing_save)
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5,))
+        with pytest.raises(OSError):
+            snapshot.refresh(fake_client)
+        assert [entry for entry in os.listdir(tmp_path) if entry.startswith('.build-')] == []
+        assert not os.path.lexists(tmp_path / 'current')
+
+
+class TestGet:
+    def test_brand_outside_hot_set_is_not_served(self, tmp_path, fake_client, versions):
+        backend.SeriesSnapshot(str(tmp_path), (5, 6)).refresh(fake_client)
+        assert backend.SeriesSnapshot(str(tmp_path), (5,)).get(6) is None
+        assert backend.SeriesSnapshot(str(tmp_path), ()).get(5) is None
+
+    def test_hot_set_mismatch_returns_none(self, tmp_path, fake_client, versions):
+        backend.SeriesSnapshot(str(tmp_path), (5,)).refresh(fake_client)
+        assert backend.SeriesSnapshot(str(tmp_path), (5, 6)).get(5) is None
+
+    def test_load_failure_returns_none(self, tmp_path, fake_client, versions):
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5,))
+        snapshot.refresh(fake_client)
+        os.remove(tmp_path / 'current' / 'manifest.json')
+        assert backend.SeriesSnapshot(str(tmp_path), (5,)).get(5) is None
+
+    def test_weekly_endpoint_serves_snapshot_without_database(self, tmp_path, api, fake_client, versions, monkeypatch):
+        snapshot = backend.SeriesSnapshot(str(tmp_path), (5,))
+        snapshot.refresh(fake_client)
+        monkeypatch.setattr(backend, 'series_snapshot', snapshot)
+        calls = len(fake_client.calls)
+
+        response = api.get('/api/v1/metrics/5/weekly?start_date=2022-01-10')
+        assert [row['totalIroas'] for row in response.json['data']] == [2.0, 3.0]
+        assert len(fake_client.calls) == calls
+
+    def test_weekly_endpoint_falls_back_on_hot_set_mismatch(self, tmp_path, api, fake_client, versions, monkeypatch):
+        backend.SeriesSnapshot(str(tmp_path), (5,)).refresh(fake_client)
+        monkeypatch.setattr(backend, 'series_snapshot', backend.SeriesSnapshot(str(tmp_path), (5, 6)))
+
+        response = api.get('/api/v1/metrics/5/weekly')
+        assert response.json['data'][0]['totalIroas'] == 9.0
+
+
+class TestSnapshotRows:
+    @pytest.fixture
+    def series(self):
+        series = {'reportDate': np.array(['2022-01-03', '2022-01-10', '2022-01-17'], dtype='datetime64[D]')}
+        for column in backend.SNAPSHOT_COLUMNS:
+            series[column] = np.array([1.0, np.nan, 3.0])
+        return series
+
+    def test_returns_all_rows_without_range(self, series):
+        rows = backend.snapshot_rows(series)
+        assert [row[0].isoformat() for row in rows] == ['2022-01-03', '2022-01-10', '2022-01-17']
+        assert rows[1][1] is None
+
+    def test_range_is_inclusive(self, series):
+        rows = backend.snapshot_rows(series, '2022-01-10', '2022-01-17')
+        assert [row[0].isoformat() for row in rows] == ['2022-01-10', '2022-01-17']
+
+    def test_range_between_report_dates(self, series):
+        assert [row[0].isoformat() for row in backend.snapshot_rows(series, start_date='2022-01-04')] == \
+            ['2022-01-10', '2022-01-17']
+        assert [row[0].isoformat() for row in backend.snapshot_rows(series, end_date='2022-01-09')] == \
+            ['2022-01-03']